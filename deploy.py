@@ -32,6 +32,11 @@ logging.basicConfig(format='[%(asctime)s] %(message)s',
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# compiled once at import - matched repeatedly while polling deploy progress
+task_definition_regex = re.compile(
+    r'^arn:aws:ecs:.*:[0-9]{12}:task-definition\/(.*)'
+)
+
 
 def get_nested_key(data, keys, default=None):
     """
@@ -275,7 +280,7 @@ class Deployment:
 
     def get_ecs_task_from_arn(self, arn):
         """Return ECS task fragment from given arn."""
-        return re.search(r'^arn:aws:ecs:.*:[0-9]{12}:task-definition\/(.*)', arn).group(1)
+        return task_definition_regex.search(arn).group(1)
 
     def get_service_update_progress(self, ecs_service_task_definition_arn, describe_services):
         """Check progress of service update.  Return True if succeeded."""
@@ -376,10 +381,10 @@ class Deployment:
 
     def cleanup(self):
         """Clean up after terraform run."""
+        shutil.rmtree(".terraform", ignore_errors=True)
         try:
-            shutil.rmtree(".terraform")
             os.remove(".terragrunt")
-        except:
+        except OSError:
             pass
 
 
@@ -264,10 +264,10 @@ remote_state = {{
 
     def cleanup(self):
         # clean up after terraform run
+        shutil.rmtree(".terraform", ignore_errors=True)
         try:
-            shutil.rmtree(".terraform")
             os.remove(".terragrunt")
-        except:
+        except OSError:
             pass
 
     def prod(self):
@@ -11,11 +11,15 @@ Options:
     -l <leg>, --leg <leg>
 """
 
-from os import environ, path, access, X_OK
+from os import environ, path, access, listdir, X_OK
+import re
 import sys
-from subprocess import check_call
-from docopt import docopt
-import botocore.exceptions
+import shlex
+import tarfile
+import threading
+from subprocess import (
+    check_call, check_output, Popen, PIPE, CalledProcessError
+)
 from base64 import b64decode
 import json
 
@@ -28,6 +32,57 @@ def executable(f):
     return path.isfile(f) and access(f, X_OK)
 
 
+def docker_supports_password_stdin():
+    """Return whether docker login takes --password-stdin (Docker >= 17.07)."""
+    try:
+        output = check_output(['docker', '--version']).decode('utf-8')
+    except (OSError, CalledProcessError):
+        return False
+    found = re.search(r'(\d+)\.(\d+)', output)
+    if found is None:
+        return False
+    return (int(found.group(1)), int(found.group(2))) >= (17, 7)
+
+
+FLAG_NAMES = {'-c': '--component-name', '--component-name': '--component-name',
+              '-l': '--leg', '--leg': '--leg'}
+
+
+def _parse_flag(arg, args, arguments):
+    """
+    Consume one flag (separate or inline value); False if arg is not a flag.
+    """
+    if arg in FLAG_NAMES:
+        value = next(args, None)
+        if value is None:
+            raise SystemExit(__doc__)
+        arguments[FLAG_NAMES[arg]] = value
+        return True
+    name, _, inline_value = arg.partition('=')
+    if name.startswith('--') and name in FLAG_NAMES:
+        arguments[FLAG_NAMES[name]] = inline_value
+        return True
+    return False
+
+
+def parse_argv(argv):
+    """
+    Parse the release command line (see module docstring for usage).
+
+    Produces the same dict docopt did for this grammar, which is simple
+    enough not to warrant docopt's usage-string parsing on every start-up.
+    """
+    arguments = {'<version>': None, '--component-name': None, '--leg': None}
+    args = iter(argv)
+    for arg in args:
+        if _parse_flag(arg, args, arguments):
+            continue
+        if arg.startswith('-') or arguments['<version>'] is not None:
+            raise SystemExit(__doc__)
+        arguments['<version>'] = arg
+    return arguments
+
+
 class Release:
 
     """
@@ -35,7 +90,7 @@ class Release:
     """
 
     def __init__(self, argv, environ, shell_runner=None, service_json_loader=None, platform_config_loader=None):
-        arguments = docopt(__doc__, argv=argv)
+        arguments = parse_argv(argv)
         self.shell_runner = shell_runner if shell_runner is not None else util.ShellRunner()
         self.version = arguments.get('<version>')
         self.component_name = util.get_component_name(arguments, environ, self.shell_runner)
@@ -58,6 +113,7 @@ class Release:
             self.version
         )
         self.aws = None
+        self.ecr_client = None
 
     def _get_aws(self):
         """
@@ -75,9 +131,11 @@ class Release:
 
     def _ecr(self):
         """
-        Get an ECR client.
+        Get an ECR client, constructing it once and reusing it.
         """
-        return self._get_aws().client('ecr')
+        if self.ecr_client is None:
+            self.ecr_client = self._get_aws().client('ecr')
+        return self.ecr_client
 
     def _build_slug(self):
         """
@@ -85,17 +143,22 @@ class Release:
         """
         print(PREFIX + 'building slug')
         self.shell_runner.run("mkdir -p target")
-        self.shell_runner.run("""
-            tar -cf - $(
-                    ls -A |
-                    grep -v '^.git/\\{0,1\\}$' |
-                    grep -v '^build/\\{0,1\\}$' |
-                    grep -v '^target/\\{0,1\\}$' |
-                    grep -v '^infrastructure/\\{0,1\\}$' |
-                    grep -v '^node_modules/\\{0,1\\}$'
-                ) | docker run -v /tmp/cache:/tmp/cache:rw --rm -i -a stdin -a stdout -a stderr
-        """ + self.metadata['SLUG_BUILDER_DOCKER_OPTS'] + """ flynn/slugbuilder - > target/slug.tgz
-        """)
+        excludes = {'.git', 'build', 'target', 'infrastructure',
+                    'node_modules'}
+        with open('target/slug.tgz', 'wb') as slug:
+            builder = Popen(
+                ['docker', 'run', '-v', '/tmp/cache:/tmp/cache:rw', '--rm',
+                 '-i', '-a', 'stdin', '-a', 'stdout', '-a', 'stderr'] +
+                shlex.split(self.metadata['SLUG_BUILDER_DOCKER_OPTS']) +
+                ['flynn/slugbuilder', '-'],
+                stdin=PIPE, stdout=slug, bufsize=1024 * 1024)
+            with tarfile.open(fileobj=builder.stdin, mode='w|') as tar:
+                for name in listdir('.'):
+                    if name not in excludes:
+                        tar.add(name)
+            builder.stdin.close()
+            if builder.wait() != 0:
+                raise Exception('non-zero exit status from slugbuilder')
         self.shell_runner.run('cp /infra/Dockerfile_slug target/Dockerfile')
         self.metadata['DOCKER_BUILD_DIR'] = 'target'
 
@@ -106,34 +169,82 @@ class Release:
         if self.metadata['TYPE'] == 'slug':
             self._build_slug()
 
-        if executable('prepare-docker-build'):
-            version = self.version if self.version is not None else 'dev'
-            command = "./prepare-docker-build %s-%s %s" % (self.component_name, version,
-                                                           self.metadata['DOCKER_BUILD_DIR'])
-            print(PREFIX + "running " + command)
-            check_call(command, shell=True)
+        # overlap the ECR round-trips with the docker build
+        auth_thread = auth_result = None
+        if self.version is not None:
+            auth_thread, auth_result = self._start_ecr_auth_prefetch()
+
+        self._run_prepare_docker_build()
 
         print(PREFIX + 'building docker image %s' % self.ecr_image_name)
-        check_call("docker build -t %s %s" % (self.ecr_image_name, self.metadata['DOCKER_BUILD_DIR']), shell=True)
+        check_call(['docker', 'build', '-t', self.ecr_image_name,
+                    self.metadata['DOCKER_BUILD_DIR']])
         print(PREFIX + 'image ' + self.ecr_image_name + ' successfully built')
 
-        if executable('on-docker-build'):
-            command = './on-docker-build %s' % self.ecr_image_name
-            print(PREFIX + 'running %s' % (command))
-            check_call(command, shell=True)
+        self._run_on_docker_build()
 
         if self.version is None:
             print(PREFIX + 'no version supplied, push skipped')
         else:
-            self._push_to_ecr(self.ecr_image_name)
+            self._push_release(auth_thread, auth_result)
 
         print(PREFIX + 'done.')
 
+    def _run_prepare_docker_build(self):
+        """
+        Run the component's prepare-docker-build hook, if it has one.
+        """
+        if not executable('prepare-docker-build'):
+            return
+        version = self.version if self.version is not None else 'dev'
+        command = "./prepare-docker-build %s-%s %s" % (
+            self.component_name, version, self.metadata['DOCKER_BUILD_DIR']
+        )
+        print(PREFIX + "running " + command)
+        check_call(command, shell=True)
+
+    def _run_on_docker_build(self):
+        """
+        Run the component's on-docker-build hook, if it has one.
+        """
+        if not executable('on-docker-build'):
+            return
+        command = './on-docker-build %s' % self.ecr_image_name
+        print(PREFIX + 'running %s' % (command))
+        check_call(command, shell=True)
+
+    def _push_release(self, auth_thread, auth_result):
+        """
+        Collect the prefetched ECR auth and push the image.
+        """
+        auth_thread.join()
+        if 'error' in auth_result:
+            raise auth_result['error']
+        self._push_to_ecr(self.ecr_image_name, auth_result['auth'])
+
     def _ensure_ecr_repository_exists(self):
         """
         Create the ECR repository if it doesn't exist.
+
+        A local marker file records a successful check so later releases of
+        the same component skip the DescribeRepositories round-trip.
         """
+        marker = path.expanduser(path.join(
+            '~/.cache/infra-deployer/ecr-repo',
+            self.account_id, self.component_name
+        ))
+        if path.exists(marker):
+            return
         print(PREFIX + 'checking ECR repository')
+        self._check_or_create_ecr_repository()
+        util.ensure_dir(path.dirname(marker))
+        open(marker, 'w').close()
+
+    def _check_or_create_ecr_repository(self):
+        """
+        Look the ECR repository up, creating it if it is not found.
+        """
+        import botocore.exceptions
         try:
             self._ecr().describe_repositories(
                 repositoryNames=[self.component_name],
@@ -141,36 +252,95 @@ class Release:
         except botocore.exceptions.ClientError as err:
             if err.response['Error']['Code'] != 'RepositoryNotFoundException':
                 raise
-            self._ecr().create_repository(
-                repositoryName=self.component_name,
-            )
-            self._ecr().set_repository_policy(
-                repositoryName=self.component_name,
-                policyText=json.dumps({
-                    "Version": "2008-10-17",
-                    "Statement": [{
-                        "Sid": "allow production",
-                        "Effect": "Allow",
-                        "Principal": {"AWS": "arn:aws:iam::%s:root" % self.prod_account_id},
-                        "Action": ["ecr:GetDownloadUrlForLayer", "ecr:BatchGetImage", "ecr:BatchCheckLayerAvailability"]
-                    }]
-                }),
-            )
+            self._create_ecr_repository()
 
-    def _push_to_ecr(self, image):
+    def _create_ecr_repository(self):
         """
-        Push the image to ECR.
+        Create the ECR repository, granting the prod account pull access.
+        """
+        self._ecr().create_repository(
+            repositoryName=self.component_name,
+        )
+        self._ecr().set_repository_policy(
+            repositoryName=self.component_name,
+            policyText=json.dumps({
+                "Version": "2008-10-17",
+                "Statement": [{
+                    "Sid": "allow production",
+                    "Effect": "Allow",
+                    "Principal": {
+                        "AWS": "arn:aws:iam::%s:root" % self.prod_account_id
+                    },
+                    "Action": [
+                        "ecr:GetDownloadUrlForLayer",
+                        "ecr:BatchGetImage",
+                        "ecr:BatchCheckLayerAvailability"
+                    ]
+                }]
+            }),
+        )
+
+    def _start_ecr_auth_prefetch(self):
+        """
+        Start fetching ECR auth in a background thread.
+
+        Returns the thread and a dict that will hold either the 'auth' data
+        or the 'error' raised, to be collected after the docker build.
+        """
+        result = {}
+
+        def prefetch():
+            try:
+                result['auth'] = self._prefetch_ecr_auth()
+            except Exception as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=prefetch)
+        thread.start()
+        return thread, result
+
+    def _prefetch_ecr_auth(self):
+        """
+        Ensure the ECR repository exists and fetch an authorization token.
+
+        Called from a background thread so the AWS round-trips overlap with
+        the docker build.
         """
         self._ensure_ecr_repository_exists()
+        return self._ecr().get_authorization_token()['authorizationData']
+
+    def _push_to_ecr(self, image, auth_data=None):
+        """
+        Push the image to ECR.
+        """
+        if auth_data is None:
+            auth_data = self._prefetch_ecr_auth()
 
         print(PREFIX + 'logging into ECR')
-        auth_data = self._ecr().get_authorization_token()['authorizationData']
         for details in auth_data:
-            username, password = b64decode(details['authorizationToken'].encode('utf-8')).decode('utf-8').split(':')
-            check_call("docker login -u '%s' -p '%s' %s" % (username, password, details['proxyEndpoint']), shell=True)
+            token = b64decode(details['authorizationToken'])
+            username, _, password = token.partition(b':')
+            self._docker_login(username.decode('utf-8'), password,
+                               details['proxyEndpoint'])
 
         print(PREFIX + 'pushing image %s' % (image))
-        check_call('docker push %s' % (image), shell=True)
+        check_call(['docker', 'push', image])
+
+    def _docker_login(self, username, password, endpoint):
+        """
+        Log docker into a registry without passing the password to a shell.
+        """
+        if docker_supports_password_stdin():
+            login = Popen(['docker', 'login', '-u', username,
+                           '--password-stdin', endpoint], stdin=PIPE)
+            login.communicate(password)
+            if login.returncode != 0:
+                raise Exception('non-zero exit status from docker login')
+        else:
+            # older clients only accept the password as an argument; an
+            # argv list still keeps it away from shell parsing
+            check_call(['docker', 'login', '-u', username,
+                        '-p', password.decode('utf-8'), endpoint])
 
 
 def main():
@@ -8,34 +8,45 @@ Extracts the values of the terraform vars <required_vars>, and uses them for it'
 import os
 import sys
 import re
-from subprocess import check_call
-import shutil
-import boto3
+import threading
+from subprocess import check_call, check_output, CalledProcessError
 import hashlib
-import pdb
 import util
 
 
 s3_bucket_prefix = "terraform-tfstate-"
 required_vars = ['env', 'component', 'aws_region', 'account_id']
+required_vars_set = frozenset(required_vars)
+module_cache_dir = os.path.expanduser('~/.cache/infra-deployer/tf-modules')
+git_source_regex = re.compile(r'source\s*=\s*"git::([^"?]+)')
+max_mirror_workers = 8
+
+
+_bucket_suffix_cache = {}
+
+
+def _bucket_suffix(account_id):
+    """Short hash of the account ID used to namespace the state bucket."""
+    if account_id not in _bucket_suffix_cache:
+        digest = hashlib.md5(account_id.encode('utf-8')).hexdigest()
+        _bucket_suffix_cache[account_id] = digest[:6]
+    return _bucket_suffix_cache[account_id]
 
 
 def generate_terragrunt_config(parsed_args):
+    """Generates terragrunt config as per terragrunt documentation"""
     region = parsed_args['aws_region']
     environment = parsed_args['env']
     component_name = parsed_args['component']
-    account_id = parsed_args['account_id']
-
-    s3_bucket_suffix = hashlib.md5(account_id.encode('utf-8')).hexdigest()[:6]
-    s3_bucket_name = s3_bucket_prefix + s3_bucket_suffix
 
-    """Generates terragrunt config as per terragrunt documentation"""
-    state_file_id = "{env}-{component}".format(env=environment, component=component_name)
+    s3_bucket_name = (
+        s3_bucket_prefix + _bucket_suffix(parsed_args['account_id'])
+    )
 
-    grunt_config_template = """lock = {{
+    content = """lock = {{
   backend = "dynamodb"
   config {{
-    state_file_id = "{state_file_id}"
+    state_file_id = "{env}-{component}"
     aws_region = "{region}"
     table_name = "terragrunt_locks"
     max_lock_retries = 360
@@ -49,73 +60,210 @@ remote_state = {{
     key = "{env}/{component}/terraform.tfstate"
     region = "{region}"
   }}
-}}"""
+}}""".format(
+        env=environment,
+        component=component_name,
+        region=region,
+        s3_bucket=s3_bucket_name,
+    )
 
-    with open('.terragrunt', 'w') as f:
-        f.write(grunt_config_template.format(
-            state_file_id=state_file_id,
-            region=region,
-            s3_bucket=s3_bucket_name,
-            env=environment,
-            component=component_name
-        ))
+    # write to a temp file and publish atomically so concurrent runs
+    # sharing a working tree never see a partial config
+    tmp_path = '.terragrunt.tmp.%d' % os.getpid()
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    os.write(fd, content.encode('utf-8'))
+    os.close(fd)
+    os.rename(tmp_path, '.terragrunt')
 
 
 def assume_role(parsed_args):
-    admin_role_arn = "arn:aws:iam::" + parsed_args['account_id'] + ":role/admin"
+    credentials = util.cached_assume_role(
+        parsed_args['aws_region'], parsed_args['account_id'], 'terragrunt'
+    )
+    return {'Credentials': credentials}
 
-    unpriv_client = boto3.client('sts')
 
-    priv_role = unpriv_client.assume_role(
-        RoleArn=admin_role_arn,
-        RoleSessionName='terragrunt'
+def _git_supports_config_env():
+    """Return whether git reads GIT_CONFIG_COUNT/KEY/VALUE (git >= 2.31)."""
+    try:
+        output = check_output(["git", "version"]).decode('utf-8')
+    except (OSError, CalledProcessError):
+        return False
+    found = re.search(r'(\d+)\.(\d+)', output)
+    if found is None:
+        return False
+    return (int(found.group(1)), int(found.group(2))) >= (2, 31)
+
+
+def _repo_url(source):
+    """Strip go-getter's //subdir suffix from a module source URL."""
+    scheme_end = source.find('://')
+    start = scheme_end + 3 if scheme_end != -1 else 0
+    subdir = source.find('//', start)
+    return source[:subdir] if subdir != -1 else source
+
+
+def _git_module_sources():
+    """Return the unique git repository URLs used as module sources."""
+    sources = set()
+    for dirpath, dirnames, filenames in os.walk('infra'):
+        for filename in filenames:
+            if filename.endswith('.tf'):
+                with open(os.path.join(dirpath, filename)) as f:
+                    found = git_source_regex.findall(f.read())
+                sources.update(_repo_url(source) for source in found)
+    return sources
+
+
+def _update_module_mirror(url):
+    """Clone or refresh the local mirror of the given repository URL."""
+    mirror = os.path.join(
+        module_cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest()
     )
-    return priv_role
+    try:
+        if os.path.isdir(mirror):
+            check_call(
+                ["git", "--git-dir", mirror, "fetch", "--quiet", "--prune"]
+            )
+        else:
+            check_call(["git", "clone", "--quiet", "--mirror", url, mirror])
+    except CalledProcessError:
+        return None
+    return mirror
+
+
+def _run_threads(threads):
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def _mirror_sources(sources):
+    """Mirror the given URLs, at most max_mirror_workers at a time."""
+    mirrors = {}
+
+    def _mirror(url):
+        mirrors[url] = _update_module_mirror(url)
+
+    for start in range(0, len(sources), max_mirror_workers):
+        batch = sources[start:start + max_mirror_workers]
+        _run_threads([threading.Thread(target=_mirror, args=(url,))
+                      for url in batch])
+    return mirrors
+
+
+def _rewrite_urls_to_mirrors(sources, mirrors, env):
+    """Point git at the mirrors via GIT_CONFIG_* entries in env."""
+    count = 0
+    for url in sources:
+        if mirrors[url] is not None:
+            env['GIT_CONFIG_KEY_%d' % count] = (
+                'url.%s.insteadOf' % mirrors[url]
+            )
+            env['GIT_CONFIG_VALUE_%d' % count] = url
+            count += 1
+    env['GIT_CONFIG_COUNT'] = str(count)
+
+
+def prefetch_modules(env):
+    """Mirror git module sources so "terragrunt get" clones locally.
+
+    terragrunt/terraform get clones each git-sourced module serially
+    over the network; mirroring the (deduplicated) repositories up
+    front in parallel and rewriting their URLs to the local mirrors via
+    GIT_CONFIG_* entries in env turns those clones into fast local
+    copies. Repositories that fail to mirror are left for terraform to
+    fetch directly. The whole prefetch is skipped on git older than
+    2.31, which ignores GIT_CONFIG_* and would otherwise pay the
+    mirroring cost for nothing.
+    """
+    if not _git_supports_config_env():
+        return
+    sources = sorted(_git_module_sources())
+    if not sources:
+        return
+    util.ensure_dir(module_cache_dir)
+    _rewrite_urls_to_mirrors(sources, _mirror_sources(sources), env)
+
+
+def _extra_terraform_flags(all_args):
+    """Return extra flags to inject after the terraform subcommand.
+
+    Raises the default -parallelism=10 cap on the graph walk to 30
+    (overridable via TF_PARALLELISM) unless the caller passed their own
+    value, and skips the state refresh for plan/apply when TF_SKIP_REFRESH
+    is set.
+    """
+    if not all_args or all_args[0] not in (
+        'apply', 'plan', 'destroy', 'refresh'
+    ):
+        return []
+    subcommand = all_args[0]
+    flags = []
+    if not any(arg.startswith('-parallelism=') for arg in all_args):
+        flags.append(
+            '-parallelism=%s' % os.environ.get('TF_PARALLELISM', '30')
+        )
+    if os.environ.get('TF_SKIP_REFRESH') and subcommand in ('plan', 'apply'):
+        flags.append('-refresh=false')
+    return flags
 
 
 def terragrunt(all_args, parsed_args, role_creds):
 
     priv_creds = role_creds['Credentials']
 
-    env = os.environ.copy()
-    env['AWS_ACCESS_KEY_ID'] = priv_creds['AccessKeyId']
-    env['AWS_SECRET_ACCESS_KEY'] = priv_creds['SecretAccessKey']
-    env['AWS_SESSION_TOKEN'] = priv_creds['SessionToken']
-    env['AWS_DEFAULT_REGION'] = parsed_args['aws_region']
+    env = dict(
+        os.environ,
+        AWS_ACCESS_KEY_ID=priv_creds['AccessKeyId'],
+        AWS_SECRET_ACCESS_KEY=priv_creds['SecretAccessKey'],
+        AWS_SESSION_TOKEN=priv_creds['SessionToken'],
+        AWS_DEFAULT_REGION=parsed_args['aws_region'],
+    )
 
     tmp_secrets = util.Credstash()._generate_decrypted_credentials('platform',parsed_args['component'],parsed_args['env'],env)
-    # Required, as we want this in a predictable place for external use
-    os.symlink(tmp_secrets, '/tmp/secrets.json')
-
-    check_call(["terragrunt", "get", "infra"], env=env)
-    check_call(["terragrunt"] + all_args + ["infra"], env=env)
+    # Required, as we want this in a predictable place for external use;
+    # symlink to a temp name and replace so repeat runs don't fail with
+    # FileExistsError
+    tmp_link = '/tmp/secrets.json.%d' % os.getpid()
+    os.symlink(tmp_secrets, tmp_link)
+    os.rename(tmp_link, '/tmp/secrets.json')
+
+    prefetch_modules(env)
+
+    # modules are kept across runs (see cleanup), so ask for an update to
+    # pick up moved refs/branches
+    check_call(["terragrunt", "get", "-update=true", "infra"], env=env)
+    check_call(
+        ["terragrunt"] + all_args[:1] + _extra_terraform_flags(all_args) +
+        all_args[1:] + ["infra"],
+        env=env
+    )
 
 
 def cleanup():
-    try:
-        os.remove(".terragrunt")
-    except:
-        pass
-    try:
-        shutil.rmtree(".terraform")
-    except:
-        pass
+    # remove only the generated config and backend state, keeping the
+    # downloaded modules in .terraform for reuse
+    for leftover in (".terragrunt",
+                     os.path.join(".terraform", "terraform.tfstate")):
+        try:
+            os.remove(leftover)
+        except OSError:
+            pass
 
 
 def parse_args(args):
     found_vars = {}
-    for var in required_vars:
-        regex = re.compile('^' + var + '=')
-        for arg in args:
-            if regex.search(arg):
-                short_arg = arg.split("=")
-                found_vars[var] = short_arg[1]
-    for var in required_vars:
-        if var in found_vars:
-            pass
-        else:
+    for arg in args:
+        var, sep, value = arg.partition("=")
+        if sep and var in required_vars_set:
+            found_vars[var] = value
+    missing = [var for var in required_vars if var not in found_vars]
+    if missing:
+        for var in missing:
             sys.stderr.write("Error: Please specify missing variable: -var " + var + "=<value>")
-            sys.exit(1)
+        sys.exit(1)
 
     return found_vars
 
@@ -3,11 +3,11 @@ from subprocess import Popen, PIPE, call, check_output, check_call
 from re import match, search, sub
 from os import path, environ
 from tempfile import NamedTemporaryFile
+from datetime import datetime, timedelta
 
+import hashlib
 import os
 import json
-import boto3
-import botocore
 
 
 class UserError(Exception):
@@ -16,6 +16,15 @@ class UserError(Exception):
     pass
 
 
+def ensure_dir(directory):
+    """Create the directory (and any parents) if it does not already exist."""
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not path.isdir(directory):
+            raise
+
+
 class Credstash:
     """Credstash - manage your credentials using KMS / DynamoDB."""
 
@@ -184,6 +193,14 @@ def get_default_domain(component_name):
     return 'mergermarket.it'
 
 
+def strip_component_postfix(component_name):
+    """Return the component name with its conventional postfix removed."""
+    for postfix in ('-service', '-subscriber', '-admin'):
+        if component_name.endswith(postfix):
+            return component_name[:-len(postfix)]
+    return component_name
+
+
 def ecr_image_name(dev_account_id, region, component_name, version):
     """Return URI to Docker image."""
     return '%s.dkr.ecr.%s.amazonaws.com/%s:%s' % (dev_account_id, region, component_name, 'dev' if version is None else version)
@@ -207,7 +224,7 @@ def apply_metadata_defaults(metadata, component_name):
     set_default('DOMAIN', get_default_domain(component_name))
     set_default('DNS_NAME', None)
     if metadata['DNS_NAME'] is None and metadata['DOMAIN'] is not None:
-        metadata['DNS_NAME'] = sub(r'-(?:service|subscriber|admin)$', '', component_name)
+        metadata['DNS_NAME'] = strip_component_postfix(component_name)
 
     set_default('ELBTYPE', 'internal')
     set_default('HEALTHCHECK_SUFFIX', '/internal/healthcheck')
@@ -237,15 +254,96 @@ def role_session_name():
         raise Exception('JOB_NAME or EMAIL environment variable must be set for session name of assumed role')
 
 
+def assume_role_cache_path(account_id, role_arn):
+    """Return the cache file location for credentials for the given role."""
+    digest = hashlib.sha1((account_id + role_arn).encode('utf-8')).hexdigest()
+    return path.join(
+        path.expanduser('~/.cache/infra-deployer'), 'sts-%s.json' % digest
+    )
+
+
+EXPIRATION_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def _format_expiration(expiration):
+    """Serialise a (possibly tz-aware) expiry datetime as a UTC string."""
+    offset = expiration.utcoffset()
+    if offset is not None:
+        expiration = expiration.replace(tzinfo=None) - offset
+    return expiration.strftime(EXPIRATION_FORMAT)
+
+
+def _parse_expiration(credentials):
+    """Return the cached expiry as a datetime, or None if unreadable."""
+    try:
+        return datetime.strptime(
+            credentials['Expiration'], EXPIRATION_FORMAT
+        )
+    except (ValueError, KeyError):
+        return None
+
+
+def _read_credentials_file(cache_file):
+    """Return the parsed cache file contents, or None if unreadable."""
+    try:
+        with open(cache_file) as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return None
+
+
+def _load_cached_credentials(cache_file):
+    """Return cached credentials with at least 60s left, or None."""
+    credentials = _read_credentials_file(cache_file)
+    if credentials is None:
+        return None
+    expiration = _parse_expiration(credentials)
+    if expiration is None:
+        return None
+    if expiration - datetime.utcnow() < timedelta(seconds=60):
+        return None
+    return credentials
+
+
+def _save_cached_credentials(cache_file, credentials):
+    """Write credentials to the cache, readable only by the current user."""
+    ensure_dir(path.dirname(cache_file))
+    with open(cache_file, 'w') as f:
+        json.dump(credentials, f)
+    os.chmod(cache_file, 0o600)
+
+
+def cached_assume_role(region, account_id, session_name):
+    """Assume the admin role in the given account, caching credentials on disk.
+
+    Cached credentials are reused while they have more than 60 seconds left
+    to live, skipping the STS round-trip on repeat invocations.
+    """
+    role_arn = 'arn:aws:iam::%s:role/admin' % account_id
+    cache_file = assume_role_cache_path(account_id, role_arn)
+    credentials = _load_cached_credentials(cache_file)
+    if credentials is not None:
+        return credentials
+    import boto3
+    print("Assuming role in account %s" % account_id)
+    session = boto3.session.Session(region_name=region)
+    credentials = session.client('sts').assume_role(
+        RoleArn=role_arn,
+        RoleSessionName=session_name,
+        DurationSeconds=3600,
+    )['Credentials']
+    credentials['Expiration'] = _format_expiration(credentials['Expiration'])
+    _save_cached_credentials(cache_file, credentials)
+    return credentials
+
+
 def assume_role_credentials(region, account_id, prod=False):
     """Assume given role and return credentials."""
-    print("Assuming role in account %s" % account_id)
+    import botocore.exceptions
     try:
-        session = boto3.session.Session(region_name=region)
-        credentials = session.client('sts').assume_role(
-            RoleArn=('arn:aws:iam::%s:role/admin' % account_id),
-            RoleSessionName=role_session_name(),
-        )['Credentials']
+        credentials = cached_assume_role(
+            region, account_id, role_session_name()
+        )
     except botocore.exceptions.NoCredentialsError as e:
         raise UserError('could not connect to AWS mergermarket account: ' + str(e))
     return credentials['AccessKeyId'], credentials['SecretAccessKey'], credentials['SessionToken']
@@ -253,6 +351,7 @@ def assume_role_credentials(region, account_id, prod=False):
 
 def assume_role(region, account_id, prod=False):
     """Assume given role."""
+    import boto3
     access_key_id, secret_access_key, session_token = assume_role_credentials(region, account_id, prod)
     return boto3.session.Session(
         aws_access_key_id=access_key_id,
@@ -316,7 +415,10 @@ region = "{region}"
 }}
 }}"""
 
-        with open('.terragrunt', 'w') as f:
+        # write to a temp file and publish atomically so concurrent runs
+        # sharing a working tree never see a partial config
+        tmp_path = '.terragrunt.tmp.%d' % os.getpid()
+        with open(tmp_path, 'w') as f:
             f.write(grunt_config_template.format(
                 state_file_id=state_file_id,
                 region=self.metadata['REGION'],
@@ -324,6 +426,7 @@ region = "{region}"
                 env=self.environment,
                 component=self.component
             ))
+        os.rename(tmp_path, '.terragrunt')
 
     def run(self, action, secrets, tfargs):
         """Run terragrunt."""